@@ -26,13 +26,30 @@ Options:
 from __future__ import print_function, absolute_import
 
 from collections import namedtuple
-from fnmatch import fnmatch
+from fnmatch import fnmatch, translate
 import json
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
 import os
 import plistlib
+import re
 import shutil
 import subprocess
 import sys
+import time
+
+try:
+    from os import scandir
+except ImportError:  # Python 2
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    import biplist
+except ImportError:
+    biplist = None
 
 import docopt
 from workflow import (
@@ -55,6 +72,9 @@ ICON_UPDATE = 'update-available.png'
 VERSION_FILE = os.path.join(os.path.dirname(__file__), 'workflow/version')
 MIN_VERSION = Version(open(VERSION_FILE).read())
 
+# version assumed for copies of AW that have no version file
+DEFAULT_VERSION = Version('0.0.1')
+
 # path to good copy of Alfred-Workflow
 WF_DIR = os.path.join(os.path.dirname(__file__), 'workflow')
 
@@ -79,6 +99,45 @@ MATCH = (MATCH_STARTSWITH |
          MATCH_INITIALS_STARTSWITH |
          MATCH_SUBSTRING)
 
+# Identifies Alfred-Workflow's `workflow.py` and how many bytes of
+# the file to search for it first
+AW_AUTHOR = b'Dean Jackson <deanishe@deanishe.net>'
+HEADER_SIZE = 4096
+
+# Number of threads to read workflows with
+MAX_WORKERS = 8
+
+# Where Alfred-Workflow is usually installed within a workflow
+AW_LOCATIONS = ('workflow', 'lib/workflow', 'src/workflow')
+
+# Directories not worth searching for a copy of Alfred-Workflow
+SKIP_DIRS = ('.git', '__pycache__')
+
+# Actions shown by `list_actions`
+ACTIONS = [
+    dict(title='Dry Run',
+         subtitle='Show what the workflow would update',
+         arg='dryrun',
+         uid='dryrun',
+         valid=True),
+    dict(title='View Log File',
+         subtitle='Open the log file in Console.app',
+         arg='log',
+         uid='log',
+         valid=True),
+    dict(title='Edit Blacklist',
+         subtitle='List of workflows to *not* update',
+         arg='blacklist',
+         uid='blacklist',
+         valid=True),
+    dict(title='Fix Workflows',
+         subtitle=('Replace broken versions of Alfred-Workflow '
+                   'within your workflows'),
+         arg='fix',
+         uid='fix',
+         valid=True),
+]
+
 Workflow = namedtuple('Workflow', 'name id dir aw')
 AWInfo = namedtuple('AWInfo', 'dir version')
 
@@ -89,40 +148,153 @@ def touch(path):
         os.utime(path, None)
 
 
+def _read_binary_plist(path, data):
+    """Parse binary plist ``data`` read from ``path``.
+
+    Uses ``biplist`` if it's installed, otherwise ``plutil`` is called
+    to convert the file to XML.
+    """
+    if biplist is not None:
+        return biplist.readPlistFromString(data)
+
+    cmd = ['plutil', '-convert', 'xml1', '-o', '-', path]
+    return plistlib.readPlistFromString(subprocess.check_output(cmd))
+
+
 def read_plist(path):
-    """Convert plist to XML and read its contents."""
+    """Read XML or binary property list."""
     if isinstance(path, unicode):
         path = path.encode('utf-8')
 
-    cmd = ['plutil', '-convert', 'xml1', '-o', '-', path]
-    xml = subprocess.check_output(cmd)
-    return plistlib.readPlistFromString(xml)
+    with open(path, 'rb') as fp:
+        data = fp.read()
+
+    if data.startswith(b'bplist'):
+        return _read_binary_plist(path, data)
+
+    return plistlib.readPlistFromString(data)
+
+
+def _listdir(dirpath):
+    """Return ``(name, path, islink, isdir)`` for each entry in ``dirpath``.
+
+    ``isdir`` is ``True`` for directories and ``islink`` for symlinks
+    to directories. Other entries are neither. Uses ``scandir`` if
+    available, so entries can be identified without calling ``stat``
+    on each one.
+    """
+    entries = []
+    if scandir is not None:
+        for e in scandir(dirpath):
+            isdir = e.is_dir(follow_symlinks=False)
+            islink = not isdir and e.is_symlink() and e.is_dir()
+            entries.append((e.name, e.path, islink, isdir))
+
+        return entries
+
+    for name in os.listdir(dirpath):
+        p = os.path.join(dirpath, name)
+        # only call lstat for directories
+        islink = isdir = os.path.isdir(p)
+        if isdir:
+            islink = os.path.islink(p)
+            isdir = not islink
+
+        entries.append((name, p, islink, isdir))
+
+    return entries
+
+
+def _subdirs(dirpath):
+    """Return ``(name, path)`` of each subdirectory of ``dirpath``.
+
+    Symlinks are ignored.
+    """
+    return [(name, p) for name, p, _, isdir in _listdir(dirpath) if isdir]
+
+
+def _is_real_dir(dirpath, relpath):
+    """Whether ``relpath`` is a directory under ``dirpath``.
+
+    Returns ``False`` if ``relpath`` or any of its parents below
+    ``dirpath`` is a symlink, as the directory search ignores them.
+    """
+    p = dirpath
+    for name in relpath.split('/'):
+        p = os.path.join(p, name)
+        if not os.path.isdir(p) or os.path.islink(p):
+            return False
+
+    return True
+
+
+def _find_workflow_dirs(dirpath):
+    """Yield directories under ``dirpath`` that contain a ``workflow.py``.
+
+    The usual locations in ``AW_LOCATIONS`` are tried first, then the
+    whole tree is searched. Only directories called ``workflow`` are
+    considered. Symlinks, hidden directories and those in
+    ``SKIP_DIRS`` are not searched.
+    """
+    found = set()
+    for rel in AW_LOCATIONS:
+        p = os.path.join(dirpath, rel)
+        if (_is_real_dir(dirpath, rel) and
+                os.path.isfile(os.path.join(p, 'workflow.py'))):
+            found.add(p)
+            yield p
+
+    stack = [dirpath]
+    while stack:
+        try:
+            subdirs = _subdirs(stack.pop())
+        except OSError as err:
+            log.debug('could not read directory: %s', err)
+            continue
+
+        # reversed, so subdirectories are popped in listing order
+        for name, p in reversed(subdirs):
+            if name.startswith('.') or name in SKIP_DIRS:
+                continue
+
+            if (name == 'workflow' and p not in found and
+                    os.path.isfile(os.path.join(p, 'workflow.py'))):
+                yield p
+
+            stack.append(p)
+
+
+def _is_aw(path):
+    """Return ``True`` if ``path`` is Alfred-Workflow's ``workflow.py``.
+
+    The author's name is in the file header, so only the beginning of
+    the file is read unless the name isn't found there.
+    """
+    with open(path, 'rb') as fp:
+        text = fp.read(HEADER_SIZE)
+        if AW_AUTHOR in text:
+            return True
+
+        return AW_AUTHOR in text + fp.read()
 
 
 def get_aw_info(dirpath):
     """Return version and directory of AW if it's installed."""
-    candidates = []
-    for root, _, filenames in os.walk(dirpath):
-        if 'workflow.py' in filenames and os.path.basename(root) == 'workflow':
-            candidates.append(root)
-
-    for dp in candidates:
+    for dp in _find_workflow_dirs(dirpath):
         wp = os.path.join(dp, 'workflow.py')
         vp = os.path.join(dp, 'version')
 
-        with open(wp) as fp:
-            text = fp.read()
-        if 'Dean Jackson <deanishe@deanishe.net>' not in text:
+        if not _is_aw(wp):
             log.debug('non-AW workflow.py ignored')
             continue
 
-        if os.path.exists(vp):
-            with open(vp) as fp:
+        try:
+            with open(vp, 'rb') as fp:
                 v = Version(fp.read().strip())
-        else:
+        except (IOError, OSError):
             log.warning('no version file in %s, assuming a very old version',
                         dirpath)
-            v = Version('0.0.1')
+            v = DEFAULT_VERSION
 
         return AWInfo(dp, v)
 
@@ -135,17 +307,115 @@ def get_workflow_info(dirpath):
     if not os.path.exists(ip):
         return None
 
+    # Look for AW first, as it's cheaper than reading info.plist
+    aw = get_aw_info(dirpath)
+    if not aw:
+        return None
+
     info = read_plist(ip)
     name = info['name']
     bid = info['bundleid']
     if not bid:  # can't be an AW workflow - it requires a bundle ID
         return None
 
-    aw = get_aw_info(dirpath)
-    if not aw:
+    return Workflow(name, bid, dirpath, aw)
+
+
+def _mtime(path):
+    """Return modification time of ``path`` or ``None`` if it doesn't exist."""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
         return None
 
-    return Workflow(name, bid, dirpath, aw)
+
+def _scan_mtimes(dirpath, awdir):
+    """Return mtimes of the files a workflow's cached info depends on.
+
+    Returns:
+        tuple: mtimes of ``info.plist``, ``workflow.py`` and ``version``.
+            ``None`` for any file that doesn't exist.
+    """
+    return (_mtime(os.path.join(dirpath, 'info.plist')),
+            _mtime(os.path.join(awdir, 'workflow.py')),
+            _mtime(os.path.join(awdir, 'version')))
+
+
+def load_scan_cache():
+    """Load workflow info cached by previous runs.
+
+    Returns:
+        dict: ``{dirpath: [info.plist mtime, workflow.py mtime,
+            version mtime, name, bundle ID, AW directory, AW version]}``
+    """
+    try:
+        with open(wf.cachefile('scan.json'), 'rb') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_scan_cache(results):
+    """Cache workflow info from `_probe` ``results`` for the next run."""
+    cache = {}
+    for dirpath, info, mtimes, _ in results:
+        if info and mtimes:
+            cache[dirpath] = list(mtimes) + [info.name, info.id, info.aw.dir,
+                                             info.aw.version.vstr]
+
+    with open(wf.cachefile('scan.json'), 'wb') as fp:
+        json.dump(cache, fp)
+
+
+def cached_workflow_info(dirpath, cache):
+    """Return cached `Workflow` for ``dirpath`` if it hasn't changed.
+
+    Returns:
+        tuple: ``(info, mtimes)`` or ``(None, None)``
+    """
+    entry = cache.get(dirpath)
+    if not entry or len(entry) != 7:  # missing or old format
+        return None, None
+
+    ip_mtime, wp_mtime, vp_mtime, name, bid, awdir, version = entry
+    mtimes = (ip_mtime, wp_mtime, vp_mtime)
+    # AW has been deleted if workflow.py is gone
+    if wp_mtime is None or _scan_mtimes(dirpath, awdir) != mtimes:
+        return None, None
+
+    info = Workflow(name, bid, dirpath, AWInfo(awdir, Version(version)))
+    return info, mtimes
+
+
+def _probe(dirpath, cache):
+    """Return info on workflow in ``dirpath``, catching any error.
+
+    ``cache`` is the cache loaded by `load_scan_cache`. If it's
+    out of date, `get_workflow_info` is called. ``mtimes`` are
+    those of the files the info was read from, or ``None`` if
+    the info shouldn't be cached.
+
+    Returns:
+        tuple: ``(dirpath, info, mtimes, error)``
+    """
+    try:
+        info, mtimes = cached_workflow_info(dirpath, cache)
+        if info:
+            log.debug('using cached info: %s', dirpath)
+            return dirpath, info, mtimes, None
+
+        start = int(time.time())
+        info = get_workflow_info(dirpath)
+        if info:
+            mtimes = _scan_mtimes(dirpath, info.aw.dir)
+            # files modified since the read started may have
+            # changed after they were read, so don't cache them
+            if any(t is not None and t >= start for t in mtimes):
+                mtimes = None
+
+        return dirpath, info, mtimes, None
+    except Exception as err:
+        return dirpath, None, None, err
 
 
 def get_workflow_directory():
@@ -203,29 +473,69 @@ def get_workflow_directory():
 
 def load_blacklist():
     """Load bundle IDs of blacklisted workflows."""
-    blacklisted = []
     p = wf.datafile('blacklist.txt')
-    if os.path.exists(p):
-        with open(p) as fp:
-            for line in fp:
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
-                blacklisted.append(line)
+    if not os.path.exists(p):
+        return []
 
-    return blacklisted
+    with open(p, 'rb') as fp:
+        lines = [line.strip() for line in fp.read().splitlines()]
+
+    return [line for line in lines if line and not line.startswith(b'#')]
+
+
+def compile_blacklist(patterns):
+    """Combine blacklist glob patterns into a single regex.
+
+    Returns ``None`` if there are no patterns.
+    """
+    if not patterns:
+        return None
+
+    return re.compile('|'.join('(?:{})'.format(translate(pat))
+                               for pat in patterns))
 
 
 def _newname(path):
-    """Return new, unused name by adding digits."""
-    i = 1
-    newpath = path
+    """Return new, unused name by adding digits.
+
+    Assumes the numbered names are used in sequence, so the first
+    free one can be found by binary search.
+    """
+    if not os.path.exists(path):
+        return path
+
+    def name(i):
+        return '{}.{}'.format(path, i)
+
+    # find a free number, then narrow it down to the lowest one
+    lo, hi = 0, 1
+    while os.path.exists(name(hi)):
+        lo, hi = hi, hi * 2
+
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if os.path.exists(name(mid)):
+            lo = mid
+        else:
+            hi = mid
+
+    return name(hi)
+
 
-    while os.path.exists(newpath):
-        newpath = '{}.{}'.format(path, i)
-        i += 1
+def copy_aw(dest):
+    """Copy this workflow's version of Alfred-Workflow to ``dest``.
 
-    return newpath
+    Files are cloned (APFS) if possible, otherwise they're copied.
+    """
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.check_call(['cp', '-cR', WF_DIR + '/', dest],
+                                  stderr=devnull)
+    except (OSError, subprocess.CalledProcessError) as err:
+        log.debug('    could not clone AW, copying instead: %s', err)
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        shutil.copytree(WF_DIR, dest)
 
 
 def update_workflow(info):
@@ -235,7 +545,7 @@ def update_workflow(info):
     log.debug('    moving %s to %s ...', info.aw.dir, newdir)
     os.rename(info.aw.dir, newdir)
     log.debug('    copying new version of AW to %s ...', info.aw.dir)
-    shutil.copytree(WF_DIR, info.aw.dir)
+    copy_aw(info.aw.dir)
     log.info('    installed new version of Alfred-Workflow')
 
     # Create file to let Alfred know this workflow is okay
@@ -257,32 +567,10 @@ def list_actions(opts):
                     autocomplete='workflow:update',
                     icon=ICON_UPDATE)
 
-    items = [
-        dict(title='Dry Run',
-             subtitle='Show what the workflow would update',
-             arg='dryrun',
-             uid='dryrun',
-             valid=True),
-        dict(title='View Log File',
-             subtitle='Open the log file in Console.app',
-             arg='log',
-             uid='log',
-             valid=True),
-        dict(title='Edit Blacklist',
-             subtitle='List of workflows to *not* update',
-             arg='blacklist',
-             uid='blacklist',
-             valid=True),
-        dict(title='Fix Workflows',
-             subtitle=('Replace broken versions of Alfred-Workflow '
-                       'within your workflows'),
-             arg='fix',
-             uid='fix',
-             valid=True),
-    ]
+    items = ACTIONS
 
     if query:
-        items = wf.filter(query, items, key=lambda d: d['title'],
+        items = wf.filter(query, items, key=itemgetter('title'),
                           match_on=MATCH, min_score=50)
 
     if not items:
@@ -318,6 +606,7 @@ def main(wf):
     log.info('workflow directory: %r', root)
 
     blacklisted = load_blacklist()
+    blacklist = compile_blacklist(blacklisted)
 
     updated = 0
     failed = 0
@@ -325,24 +614,38 @@ def main(wf):
     # loop through subdirectories of workflow directory
     #   1. ignore symlinks
     #   2. ignore files
-    #   3. ignore blacklisted workflows
-    #   4. identify AW workflows
-    #   5. check version of AW the workflow has
-    #   6. if AW is outdated, backup the existing copy and replace
-    #      it with an up-to-date version of AW
-    for dn in os.listdir(root):
-        p = os.path.join(root, dn)
-        if os.path.islink(p):
+    paths = []
+    for dn, p, islink, isdir in _listdir(root):
+        if islink:
             log.info('ignoring symlink: %s', dn)
             continue
 
-        if not os.path.isdir(p):
+        if not isdir:
             log.debug('ignoring non-directory: %s', dn)
             continue
 
-        try:
-            info = get_workflow_info(p)
-        except Exception as err:
+        paths.append(p)
+
+    # reading workflows is all I/O, so do it in parallel
+    cache = load_scan_cache()
+    pool = ThreadPool(MAX_WORKERS)
+    try:
+        results = pool.map(lambda p: _probe(p, cache), paths)
+    finally:
+        pool.close()
+        pool.join()
+
+    save_scan_cache(results)
+
+    # loop through workflows
+    #   3. ignore blacklisted workflows
+    #   4. identify AW workflows
+    #   5. check version of AW the workflow has
+    #   6. if AW is outdated, backup the existing copy and replace
+    #      it with an up-to-date version of AW
+    for p, info, _, err in results:
+        dn = os.path.basename(p)
+        if err:
             log.error('could not read workflow: %s: %s', dn, err)
             continue
 
@@ -354,15 +657,10 @@ def main(wf):
             log.debug('ignoring self')
             continue
 
-        ok = True
-        for pat in blacklisted:
-            if fnmatch(info.id, pat):
-                log.debug('blacklisted: "%s" matches "%s"', info.id, pat)
-                log.info('skipping blacklisted workflow: %s', dn)
-                ok = False
-                break
-
-        if not ok:
+        if blacklist and blacklist.match(info.id):
+            pat = next(pat for pat in blacklisted if fnmatch(info.id, pat))
+            log.debug('blacklisted: "%s" matches "%s"', info.id, pat)
+            log.info('skipping blacklisted workflow: %s', dn)
             continue
 
         log.info('')